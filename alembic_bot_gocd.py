@@ -1,18 +1,32 @@
 import ast
+import configparser
 import datetime
+import functools
 import os
+import random
 import re
 import subprocess
 import sys
+import threading
 import time
 import uuid
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from dataclasses import dataclass, field
 from http import HTTPStatus
-from typing import Generator, Optional, Tuple
+from typing import Dict, Generator, List, Optional, Tuple
 
 import botocore.exceptions
 import botocore.session
 import requests
+import requests.adapters
+
+
+_ALEMBIC_NAME_RE = re.compile(r"(alembic_\w+)")
+_REVISION_RE = re.compile(rb"^revision = ['\"]([\w_]+)['\"]", re.MULTILINE)
+_DOWN_REVISION_RE = re.compile(rb"^down_revision = ['\"]([\w_]+)['\"]", re.MULTILINE)
+_SEQ_REV_RE = re.compile(r"^(\d{5})_(.{5})$")
 
 
 dynamodb_config = {}  # XXX: credentials to authenticate to AWS
@@ -23,9 +37,13 @@ dynamodb_client = bs.create_client(
 )
 
 
+slack_session = requests.Session()
+slack_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
 slack_messages = []
 
 
+@functools.lru_cache(maxsize=1)
 def get_current_git_head() -> Optional[str]:
     process = subprocess.Popen(
         ["git", "rev-parse", "HEAD"],
@@ -33,15 +51,16 @@ def get_current_git_head() -> Optional[str]:
         stderr=subprocess.PIPE,
     )
     stdout, stderr = process.communicate()
+    stdout = stdout.decode("utf-8").rstrip(" \n")
     if process.returncode:
         print("`git rev-parse HEAD` failed with return code {}, stdout: {}; stderr: {}".format(
             process.returncode,
-            stdout.decode("utf-8").rstrip(" \n"),
+            stdout,
             stderr.decode("utf-8").rstrip(" \n"),
         ))
         return None
 
-    return stdout.decode("utf-8").rstrip(" \n")
+    return stdout
 
 
 def execute(*args) -> int:
@@ -61,87 +80,236 @@ def execute(*args) -> int:
     return process.returncode
 
 
-def parse_revisions_from_file(file_contents: bytes) -> Tuple[Optional[str], Optional[str]]:
+@dataclass(slots=True)
+class RevisionNode:
+    revision: str
+    filepath: str
+    # revisions that have this revision as down_revision
+    parents: set = field(default_factory=set)
+    # down revisions of this revision
+    children: set = field(default_factory=set)
+
+
+class GitCatFile:
+    # persistent `git cat-file --batch` process, used to read blobs without forking `git` once per file
+
+    def __init__(self, rev: str = "HEAD") -> None:
+        self.rev = rev
+        self.process: Optional[subprocess.Popen] = None
+        self.writer: Optional[threading.Thread] = None
+
+    def __enter__(self) -> "GitCatFile":
+        self.process = subprocess.Popen(
+            ["git", "cat-file", "--batch"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is not None:
+            # responses may be left unread, git would block on a full stdout pipe forever
+            self.process.kill()
+        if self.writer:
+            self.writer.join()
+            self.writer = None
+        if exc_type is None:
+            self.process.stdin.close()
+        self.process.wait()
+        self.process = None
+
+    def read_many(self, paths: List[str]) -> Generator[Optional[bytes], None, None]:
+        # submit every request at once and yield the responses in order as git produces them,
+        # so the caller can parse one file while git is still reading the next ones;
+        # requests are written from a separate thread so a full stdout pipe can't deadlock us
+        relpaths = [os.path.relpath(path) for path in paths]
+        # git exits on paths outside of the repository, those are never tracked and are answered as missing
+        in_repository = [relpath != os.pardir and not relpath.startswith(os.pardir + os.sep) for relpath in relpaths]
+        batch = "".join(
+            f"{self.rev}:./{relpath}\n"
+            for relpath, tracked in zip(relpaths, in_repository)
+            if tracked
+        ).encode("utf-8")
+        self.writer = threading.Thread(target=self._write, args=(batch,))
+        self.writer.start()
+        for tracked in in_repository:
+            yield self._read_response() if tracked else None
+
+    def _write(self, data: bytes) -> None:
+        try:
+            self.process.stdin.write(data)
+            self.process.stdin.flush()
+        except BrokenPipeError:
+            # process was killed before all requests were written
+            pass
+
+    def _read_response(self) -> Optional[bytes]:
+        # header is either `<sha> <type> <size>` or `<object> missing|ambiguous`,
+        # where `<object>` is the requested `rev:path` and may itself contain spaces
+        header = self.process.stdout.readline().rstrip(b"\n")
+        # empty header means git exited, remaining files are read from disk by the caller
+        if not header or header.endswith((b" missing", b" ambiguous")):
+            return None
+
+        _, object_type, size = header.rsplit(b" ", 2)
+        contents = self.process.stdout.read(int(size))
+        self.process.stdout.read(1)  # trailing newline after object contents
+
+        # contents of anything but a blob (e.g. a directory) are consumed to stay in sync, but not returned
+        if object_type != b"blob":
+            return None
+
+        return contents
+
+
+def parse_revisions_from_file(file_contents: bytes, output: List[str]) -> Tuple[Optional[str], Optional[str]]:
+    # fast path: plain string literals emitted by the alembic template don't need an AST,
+    # only tuple (merge) and `None` (origin) down revisions fall through to ast.parse;
+    # those never match the quoted down_revision pattern, so it is tried first
+    if down_revision_match := _DOWN_REVISION_RE.search(file_contents):
+        if revision_match := _REVISION_RE.search(file_contents):
+            return revision_match.group(1).decode("utf-8"), down_revision_match.group(1).decode("utf-8")
+
     revision = None
     down_revision = None
+    down_revision_found = False
 
     try:
-        for node in ast.parse(file_contents.decode("utf-8")).body:
-            if isinstance(node, ast.Assign):
-                for target in node.targets:
-                    if target.id == "revision":
-                        revision = node.value.value
-                    elif target.id == "down_revision":
-                        down_revision = node.value
-                        if isinstance(down_revision, ast.Constant):
-                            down_revision = down_revision.value
-                        elif isinstance(down_revision, ast.Tuple):
-                            down_revision = tuple(d.value for d in down_revision.elts)
+        # ast.parse accepts bytes directly, no need to decode the whole file first
+        for node in ast.parse(file_contents).body:
+            if not isinstance(node, ast.Assign):
+                continue
+
+            for target in node.targets:
+                # skip tuple unpacking, attribute assignments etc.
+                if not isinstance(target, ast.Name):
+                    continue
+
+                if target.id == "revision":
+                    revision = node.value.value
+                elif target.id == "down_revision":
+                    down_revision_found = True
+                    down_revision = node.value
+                    if isinstance(down_revision, ast.Constant):
+                        down_revision = down_revision.value
+                    elif isinstance(down_revision, ast.Tuple):
+                        down_revision = tuple(d.value for d in down_revision.elts)
+
+            # both values found, rest of the module is irrelevant
+            if revision and down_revision_found:
+                break
     except Exception:
-        print(f"failed to parse file contents with AST: {file_contents}")
-        revision_match = re.search(rb"revision = ['\"]([\w_]+)['\"]", file_contents)
-        down_revision_match = re.search(rb"down_revision = ['\"]([\w_]+)['\"]", file_contents)
-        if revision_match and down_revision_match:
-            revision = revision_match.group(1)
-            down_revision = down_revision_match.group(1)
+        # the regex fallback already ran as the fast path above, nothing left to try
+        # runs on worker threads, so the message goes to the task's buffered output
+        output.append(f"failed to parse file contents with AST: {file_contents}")
 
     return revision, down_revision
 
 
-def yield_alembic_ini_paths() -> Generator[str, None, None]:
+def scan_repository() -> Tuple[List[str], Dict[str, List[str]]]:
+    # walks the repository once, collecting `alembic.ini` paths together with the migration files
+    # under every `versions` directory (keyed by its absolute path), so the migration directories
+    # don't have to be walked a second time
+
     # these directories should never be traversed into
-    ignored_directories = [
+    ignored_directories = {
         "__pycache__",
         "node_modules",
         ".git",
         ".pnpm-store",
-    ]
-
-    for dirpath, dirnames, _ in os.walk("."):
-        for ignored_name in ignored_directories:
-            if ignored_name in dirnames:
-                dirnames.remove(ignored_name)
-
-        for dirname in dirnames:
-            alembic_file = os.path.join(dirpath, dirname, "alembic.ini")
-            if os.path.isfile(alembic_file):
-                yield alembic_file
-
-
-def yield_alembic_migrations_directories() -> Generator[str, None, None]:
-    script_location_regex = re.compile(r"^script_location = (\w+)$", re.DOTALL | re.MULTILINE)
+    }
 
-    for alembic_ini_path in yield_alembic_ini_paths():
-        with open(alembic_ini_path, "r") as fp:
-            alembic_data = fp.read()
+    alembic_ini_paths = []
+    migration_files = defaultdict(list)
+
+    # scandir entries carry the file type from the directory listing,
+    # so only `alembic.ini` candidates need an extra stat
+    root = os.getcwd()
+    directories = [(root, None)]
+    while directories:
+        path, versions_dir = directories.pop()
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in ignored_directories:
+                        if versions_dir is None and entry.name == "versions":
+                            directories.append((entry.path, entry.path))
+                        else:
+                            directories.append((entry.path, versions_dir))
+                elif versions_dir is not None and entry.name.endswith(".py"):
+                    migration_files[versions_dir].append(entry.path)
+                # alembic.ini in the repository root itself is not considered
+                elif entry.name == "alembic.ini" and path != root and entry.is_file():
+                    alembic_ini_paths.append(entry.path)
+
+    return alembic_ini_paths, migration_files
+
+
+def yield_migration_files(migrations_dir: str) -> Generator[str, None, None]:
+    directories = [migrations_dir]
+    while directories:
+        path = directories.pop()
+        try:
+            entries = os.scandir(path)
+        except FileNotFoundError:
+            continue
 
-        migrations_dirs = set()
-        script_locations = script_location_regex.findall(alembic_data)
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif entry.name.endswith(".py"):
+                    yield entry.path
+
+
+def yield_alembic_migrations_directories(alembic_ini_paths: List[str]) -> Generator[str, None, None]:
+    # several alembic.ini files may point at the same script location (e.g. `../alembic_foo`),
+    # every directory must be yielded only once or its heads would get merged twice
+    migrations_dirs = set()
+    for alembic_ini_path in alembic_ini_paths:
+        alembic_ini_dir = os.path.dirname(alembic_ini_path)
+
+        # alembic itself provides `%(here)s` for interpolation in alembic.ini
+        config = configparser.ConfigParser(defaults={"here": os.path.abspath(alembic_ini_dir)})
+        config.read(alembic_ini_path)
+
+        script_locations = [
+            config.get(section, "script_location")
+            for section in config.sections()
+            if config.has_option(section, "script_location")
+        ]
         for script_location in script_locations:
-            script_location = os.path.join(os.path.dirname(alembic_ini_path), script_location)
+            script_location = os.path.join(alembic_ini_dir, script_location)
             script_location = os.path.abspath(script_location)
             migrations_dir = os.path.join(script_location, "versions")
-            migrations_dirs.add(migrations_dir)
-
-        for migrations_dir in migrations_dirs:
-            yield migrations_dir
+            if migrations_dir not in migrations_dirs:
+                migrations_dirs.add(migrations_dir)
+                yield migrations_dir
 
 
-def get_alembic_revision_graph(migrations_dir: str) -> Tuple[dict, str, dict]:
-    revision_map = dict()
-    graph = dict()
+def yield_alembic_migrations() -> Generator[Tuple[str, List[str]], None, None]:
+    alembic_ini_paths, migration_files = scan_repository()
+    for migrations_dir in yield_alembic_migrations_directories(alembic_ini_paths):
+        # script locations outside of the scanned tree still need their own walk
+        filepaths = migration_files.get(migrations_dir) or list(yield_migration_files(migrations_dir))
+        yield migrations_dir, filepaths
 
-    origin_revision = None
-    for dirpath, dirnames, filenames in os.walk(migrations_dir):
-        for filename in filenames:
-            if not filename.endswith(".py"):
-                continue
 
-            filepath = os.path.join(dirpath, filename)
-            with open(filepath, "rb") as fp:
-                file_contents = fp.read()
+def get_alembic_revisions(filepaths: List[str], output: List[str]) -> Tuple[dict, str]:
+    nodes = dict()
 
-            revision, down_revision = parse_revisions_from_file(file_contents)
+    # read committed contents of all migration files in one batch through git,
+    # parsing each file as soon as git has returned it
+    origin_revision = None
+    with GitCatFile() as git_cat_file:
+        for filepath, file_contents in zip(filepaths, git_cat_file.read_many(filepaths)):
+            # fall back to disk for files not yet tracked by git
+            if file_contents is None:
+                with open(filepath, "rb") as fp:
+                    file_contents = fp.read()
+
+            revision, down_revision = parse_revisions_from_file(file_contents, output)
             if not revision and not down_revision:
                 continue
 
@@ -149,96 +317,111 @@ def get_alembic_revision_graph(migrations_dir: str) -> Tuple[dict, str, dict]:
                 if origin_revision:
                     raise Exception(f"found multiple origin revisions: {origin_revision}, {revision}")
                 origin_revision = revision
-                down_revision = ()
+                down_revision = set()
             elif isinstance(down_revision, str):
-                down_revision = (down_revision,)
-
-            revision_map[revision] = {
-                "revision": revision,
-                "parents": (),
-                "children": down_revision,
-                "filepath": filepath,
-            }
+                down_revision = {down_revision}
+            else:
+                down_revision = set(down_revision)
+
+            nodes[revision] = RevisionNode(
+                revision=revision,
+                filepath=filepath,
+                children=down_revision,
+            )
 
     if not origin_revision:
         raise Exception("no origin revision found")
 
-    graph[origin_revision] = revision_map[origin_revision]
+    return nodes, origin_revision
+
+
+def count_heads(nodes: dict) -> int:
+    # every revision that is nobody's down_revision is a head, cheap to check without building the graph
+    down_revisions = set()
+    for node in nodes.values():
+        down_revisions.update(node.children)
+
+    return len(nodes.keys() - down_revisions)
+
+
+def get_alembic_revision_graph(nodes: dict, origin_revision: str) -> dict:
+    graph = dict()
 
-    def build_graph(node: dict) -> None:
-        for rev, revnode in revision_map.items():
-            if node["revision"] in revnode["children"]:
-                node["parents"] += (rev,)
-                if revnode["revision"] not in graph:
-                    graph[revnode["revision"]] = revnode.copy()
-                    build_graph(graph[revnode["revision"]])
+    # reverse the down_revision links once instead of scanning all nodes for every node
+    parents_of = defaultdict(list)
+    for rev, revnode in nodes.items():
+        for child in revnode.children:
+            parents_of[child].append(rev)
 
-    build_graph(graph[origin_revision])
+    # graph holds the nodes reachable from the origin revision, shared with `nodes` rather than copied
+    graph[origin_revision] = nodes[origin_revision]
 
-    return graph, origin_revision, revision_map
+    queue = deque([graph[origin_revision]])
+    while queue:
+        node = queue.popleft()
+        node.parents = set(parents_of[node.revision])
+        for parent_rev in node.parents:
+            if parent_rev not in graph:
+                graph[parent_rev] = nodes[parent_rev]
+                queue.append(graph[parent_rev])
 
+    return graph
 
-def find_heads(graph: dict, node: dict) -> list:
+
+def find_heads(graph: dict, node: RevisionNode) -> List[RevisionNode]:
     heads = []
-    processed_revisions = set()
+    visited = set()
 
-    revisions = set(node["parents"]) or {node["revision"]}
-    while revisions:
-        revision = revisions.pop()
+    frontier = deque(node.parents or [node.revision])
+    while frontier:
+        revision = frontier.popleft()
+        if revision in visited:
+            continue
+        visited.add(revision)
 
         # if revision has no parents, it's a head revision
-        if not graph[revision]["parents"]:
+        if not graph[revision].parents:
             heads.append(graph[revision])
-            processed_revisions.add(revision)
             continue
 
-        for parent_rev in graph[revision]["parents"]:
-            if parent_rev not in processed_revisions:
-                revisions.add(parent_rev)
-                processed_revisions.add(parent_rev)
+        frontier.extend(parent_rev for parent_rev in graph[revision].parents if parent_rev not in visited)
 
     return heads
 
 
-def insert_node(graph: dict, revision_map: dict, revision: str, children: tuple, parents: tuple, filepath: str) -> None:
-    revision_map[revision] = {
-        "revision": revision,
-        "parents": parents,
-        "children": children,
-        "filepath": filepath,
-    }
-
-    graph[revision] = revision_map[revision].copy()
+def insert_node(graph: dict, revision: str, children: tuple, parents: tuple, filepath: str) -> None:
+    graph[revision] = RevisionNode(
+        revision=revision,
+        filepath=filepath,
+        parents=set(parents),
+        children=set(children),
+    )
 
     for child in children:
         if child not in graph:
             raise Exception(f"Child revision {child} not found in graph")
-        graph[child]["parents"] += (revision,)
+        graph[child].parents.add(revision)
 
     for parent_rev in parents:
         if parent_rev not in graph:
             raise Exception(f"Parent revision {parent_rev} not found in graph")
-        graph[parent_rev]["children"] += (revision,)
+        graph[parent_rev].children.add(revision)
 
 
-def remove_node(graph: dict, revision_map: dict, revision: str) -> None:
-    for child in graph[revision]["children"]:
-        graph[child]["parents"] = tuple(parent_rev for parent_rev in graph[child]["parents"] if parent_rev != revision)
+def remove_node(graph: dict, revision: str) -> None:
+    # only direct neighbours can reference the removed revision
+    for child in graph[revision].children:
+        graph[child].parents.discard(revision)
 
-    for parent_rev in graph[revision]["parents"]:
-        graph[parent_rev]["children"] = tuple(child for child in graph[parent_rev]["children"] if child != revision)
+    for parent_rev in graph[revision].parents:
+        graph[parent_rev].children.discard(revision)
 
     del graph[revision]
 
-    del revision_map[revision]
-    for revnode in revision_map.values():
-        revnode["children"] = tuple(child for child in revnode["children"] if child != revision)
-        revnode["parents"] = tuple(parent_rev for parent_rev in revnode["parents"] if parent_rev != revision)
-
 
 def alembic_name(path: str) -> str:
     # return alembic folder name (i.e. `alembic_adjudication`) from path
-    return re.search(r"(alembic_\w+)", path).group(1)
+    return _ALEMBIC_NAME_RE.search(path).group(1)
 
 
 def git_path(path: str) -> str:
@@ -247,13 +430,11 @@ def git_path(path: str) -> str:
     return path
 
 
-def merge_heads(graph: dict, revision_map: dict, migrations_dir: str, revisions: list) -> str:
-    print(f"merging heads: {revisions}")
-
+def merge_heads(graph: dict, migrations_dir: str, revisions: list) -> str:
     # for sequential revisions, bump merge head revision by one
     max_rev_count = -1
     for revision in revisions:
-        if match := re.search(r"^(\d{5})_(.{5})$", revision):
+        if match := _SEQ_REV_RE.search(revision):
             rev_count = int(match.group(1))
             if rev_count > max_rev_count:
                 max_rev_count = rev_count
@@ -295,11 +476,8 @@ def downgrade():
     with open(merge_heads_file, "w") as fp:
         fp.write(merge_heads_file_contents)
 
-    execute("git", "add", merge_heads_file)
-
     insert_node(
         graph=graph,
-        revision_map=revision_map,
         revision=merge_head_revision,
         children=tuple(revisions),
         parents=(),
@@ -309,6 +487,40 @@ def downgrade():
     return merge_head_revision
 
 
+def process_migrations_dir(migrations_dir: str, filepaths: List[str]) -> Tuple[List[str], Optional[str], Optional[str]]:
+    # returns buffered output lines, plus commit message and merge heads file if heads were merged
+    output = [f"processing migrations: {migrations_dir}"]
+
+    nodes, origin_revision = get_alembic_revisions(filepaths, output)
+
+    # the common case of a single head doesn't need the revision graph at all,
+    # heads reachable from the origin are always a subset of the counted ones
+    if count_heads(nodes) <= 1:
+        return output, None, None
+
+    # get revision graph
+    graph = get_alembic_revision_graph(nodes, origin_revision)
+
+    # find heads
+    heads = find_heads(graph, graph[origin_revision])
+    if len(heads) <= 1:
+        return output, None, None
+
+    # merge heads
+    revisions_to_merge = [rev.revision for rev in heads]
+    output.append(f"merging heads: {revisions_to_merge}")
+    merge_head_revision = merge_heads(graph, migrations_dir, revisions_to_merge)
+
+    message = "merge heads ({}): {} -> {}".format(
+        alembic_name(migrations_dir),
+        ", ".join(revisions_to_merge),
+        merge_head_revision,
+    )
+    output.append(message)
+
+    return output, message, graph[merge_head_revision].filepath
+
+
 def send_slack_notifications() -> None:
     if not slack_messages:
         print("*** WARNING: nothing to notify slack about")
@@ -351,62 +563,67 @@ def send_slack_notifications() -> None:
     gocd_slack_channel_ids = {c.strip() for c in gocd_slack_channels.split(",") if c}
     gocd_slack_channel_ids.add("C033T2W8SBX")  # always send notifications to #gocd-notifications channel
 
-    for slack_channel_id in gocd_slack_channel_ids:
-        response = requests.post(
-            url="https://slack.com/api/chat.postMessage",
-            headers={
-                "Authorization": f"Bearer {slack_oauth_token}",
-                "Content-Type": "application/json; charset=UTF-8",
-            },
-            json={
-                "channel": slack_channel_id,
-                "as_user": True,
-                "attachments": [
-                    {
-                        "pretext": pretext,
-                        "color": "warning",
-                        "text": message,
-                    },
-                ],
-            },
-        )
+    def post_message(slack_channel_id: str) -> None:
+        try:
+            response = slack_session.post(
+                url="https://slack.com/api/chat.postMessage",
+                headers={
+                    "Authorization": f"Bearer {slack_oauth_token}",
+                    "Content-Type": "application/json; charset=UTF-8",
+                },
+                json={
+                    "channel": slack_channel_id,
+                    "as_user": True,
+                    "attachments": [
+                        {
+                            "pretext": pretext,
+                            "color": "warning",
+                            "text": message,
+                        },
+                    ],
+                },
+                timeout=(3.05, 10),
+            )
+        except requests.exceptions.RequestException as e:
+            print(f"failed to send notification to {slack_channel_id} ({e!r})")
+            return
+
         if response.status_code != HTTPStatus.OK or not response.json()["ok"]:
             print(f"failed to send notification to {slack_channel_id} ({response.status_code=}: {response.content=!r})")
         else:
             print(f"notified channel {slack_channel_id}")
 
+    # connections to slack are pooled by the session, post to all channels concurrently
+    with ThreadPoolExecutor(max_workers=len(gocd_slack_channel_ids)) as executor:
+        list(executor.map(post_message, gocd_slack_channel_ids))
+
 
 def main() -> None:
     # pull once to ensure we are up to date
     if return_code := execute("git", "pull"):
         print(f"`git pull` failed with return code {return_code}")
         sys.exit(return_code)
+    get_current_git_head.cache_clear()
 
     slack_messages.clear()
     commit_messages = []
-
-    for migrations_dir in yield_alembic_migrations_directories():
-        print(f"processing migrations: {migrations_dir}")
-
-        # get revision graph
-        graph, origin_revision, revision_map = get_alembic_revision_graph(migrations_dir)
-
-        # find heads
-        heads = find_heads(graph, graph[origin_revision])
-
-        # merge heads
-        if len(heads) > 1:
-            revisions_to_merge = [rev["revision"] for rev in heads]
-            merge_head_revision = merge_heads(graph, revision_map, migrations_dir, revisions_to_merge)
-
-            message = "merge heads ({}): {} -> {}".format(
-                alembic_name(migrations_dir),
-                ", ".join(revisions_to_merge),
-                merge_head_revision,
-            )
-            print(message)
-            commit_messages.append(message)
-            slack_messages.append(message)
+    merge_heads_files = []
+
+    # migration directories are independent of each other, so process them concurrently
+    migrations = list(yield_alembic_migrations())
+    with ThreadPoolExecutor(max_workers=min(8, len(migrations)) or 1) as executor:
+        futures = [
+            executor.submit(process_migrations_dir, migrations_dir, filepaths)
+            for migrations_dir, filepaths in migrations
+        ]
+        for future in futures:
+            output, message, merge_heads_file = future.result()
+            print("\n".join(output))
+
+            if message:
+                merge_heads_files.append(merge_heads_file)
+                commit_messages.append(message)
+                slack_messages.append(message)
 
     # commit to github
     if commit_messages:
@@ -419,8 +636,9 @@ def main() -> None:
         )
         stdout, stderr = process.communicate()
         if stdout:
-            print(stdout.decode("utf-8").rstrip(" \n"))
-            if "Already up to date." not in stdout.decode("utf-8"):
+            stdout = stdout.decode("utf-8")
+            print(stdout.rstrip(" \n"))
+            if "Already up to date." not in stdout:
                 print("new changes detected in master, restarting bot run to avoid race conditions")
                 # remove untracked files
                 if return_code := execute("git", "clean", "-fd"):
@@ -434,6 +652,13 @@ def main() -> None:
         if process.returncode:
             print(f"`git pull` failed with return code {process.returncode}")
             sys.exit(process.returncode)
+        get_current_git_head.cache_clear()
+
+        # stage all merge heads files with a single `git add`, only once we know no restart is needed
+        # so that `git clean` above can still remove them
+        if return_code := execute("git", "add", *merge_heads_files):
+            print(f"`git add` failed with return code {return_code}")
+            sys.exit(return_code)
 
         if return_code := execute("git", "commit", "-am", "\n".join(commit_messages)):
             print(f"`git commit` failed with return code {return_code}")
@@ -451,27 +676,39 @@ def main() -> None:
 @contextmanager
 def lock() -> Generator:
     # use dynamodb as a lock to ensure only one instance of this bot is running at a time
+    # lock expires after 15 minutes so a crashed bot can't block the others indefinitely
+    lock_ttl = 15 * 60
+    lock_owner = uuid.uuid4().hex
     wait_count = 0
+    wait_started = time.monotonic()
     try:
         while True:
+            now = int(time.time())
             try:
                 dynamodb_client.put_item(
                     TableName="alembic_bot",
                     Item={
                         "id": {"S": "lock"},
+                        "owner": {"S": lock_owner},
+                        "ttl": {"N": str(now + lock_ttl)},
                     },
-                    ConditionExpression="attribute_not_exists(id)",
+                    # `ttl` is a dynamodb reserved word
+                    ConditionExpression="attribute_not_exists(id) OR #ttl < :now",
+                    ExpressionAttributeNames={"#ttl": "ttl"},
+                    ExpressionAttributeValues={":now": {"N": str(now)}},
                 )
                 break
             except botocore.exceptions.ClientError as e:
                 if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
-                    wait_count += 1
-                    if wait_count == 90:
+                    if time.monotonic() - wait_started >= lock_ttl:
                         print("another bot still running after 15 minutes, exiting")
                         sys.exit(0)
 
-                    print("another bot already running, waiting...")
-                    time.sleep(10)
+                    # exponential backoff with jitter
+                    wait_count += 1
+                    wait_time = min(60, 1.5 ** wait_count + random.uniform(0, 1))
+                    print(f"another bot already running, waiting {wait_time:.1f}s...")
+                    time.sleep(wait_time)
                     continue
 
                 raise
@@ -480,16 +717,19 @@ def lock() -> Generator:
     except Exception:
         raise
     finally:
-        # delete lock
+        # delete lock, unless it was never acquired or has since been reclaimed by another bot
         try:
             dynamodb_client.delete_item(
                 TableName="alembic_bot",
                 Key={
                     "id": {"S": "lock"},
                 },
+                ConditionExpression="#owner = :owner",
+                ExpressionAttributeNames={"#owner": "owner"},
+                ExpressionAttributeValues={":owner": {"S": lock_owner}},
             )
         except botocore.exceptions.ClientError as e:
-            if e.response["Error"]["Code"] != "ResourceNotFoundException":
+            if e.response["Error"]["Code"] not in ("ResourceNotFoundException", "ConditionalCheckFailedException"):
                 raise
 
 
@@ -1,47 +1,89 @@
 import ast
+import configparser
+import hashlib
+import mmap
 import os
+import pickle
 import re
 import subprocess
-import time
-from typing import Any, Dict, List, Optional, Tuple
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http import HTTPStatus
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 import requests
+import requests.adapters
+from urllib3.util import Retry
 
 
 REPOSITORY: str = "organization/code.organization.com"
 GITHUB_TOKEN: str = os.environ["GITHUB_TOKEN"]
 
-master_commits: List[str] = []
+REVISION_CACHE_PATH: str = ".alembic_bot_cache.pkl"
+REVISION_CACHE_VERSION: int = 4  # bump whenever parsing changes, invalidates cached revisions
+ETAG_CACHE_PATH: str = os.path.expanduser("~/.cache/alembic-bot/etags")
+ETAG_CACHE_VERSION: int = 1
+MMAP_MIN_FILE_SIZE: int = 4096  # mapping smaller files costs more than reading them
+
+# single session so connections to GitHub are kept alive and reused across requests
+github_session = requests.Session()
+github_session.headers["Authorization"] = f"token {GITHUB_TOKEN}"
+github_session.mount("https://", requests.adapters.HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=50,
+    max_retries=Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504]),
+))
+# global cap on in-flight GitHub requests, shared by the pull request workers and their page fetches
+github_semaphore = threading.BoundedSemaphore(20)
+
+revision_cache: Dict[bytes, Tuple[Optional[str], Optional[str]]] = {}
+revision_cache_used_keys: Set[bytes] = set()
+file_revision_cache: Dict[str, Tuple[int, Tuple[Optional[str], Any]]] = {}  # filepath -> (st_mtime_ns, revisions)
+etag_cache: Dict[str, Tuple[str, Dict[str, str], bytes]] = {}  # url -> (etag, headers, body)
+etag_cache_used_urls: Set[str] = set()
+
+_REVISION_RE = re.compile(rb"^revision\s*=\s*['\"]([\w_]+)['\"]", re.MULTILINE)
+_DOWN_REVISION_RE = re.compile(rb"^down_revision\s*=\s*['\"]([\w_]+)['\"]", re.MULTILINE)
+_DOWN_REVISION_TUPLE_RE = re.compile(rb"^down_revision\s*=\s*\(([^)]*)\)", re.MULTILINE)
+_DOWN_REVISION_NONE_RE = re.compile(rb"^down_revision\s*=\s*None\b", re.MULTILINE)
+_QUOTED_REVISION_RE = re.compile(rb"['\"]([\w_]+)['\"]")
+_REVISION_FALLBACK_RE = re.compile(rb"revision = ['\"]([\w_]+)['\"]")
+_DOWN_REVISION_FALLBACK_RE = re.compile(rb"down_revision = ['\"]([\w_]+)['\"]")
+_SEQ_REV_RE = re.compile(r"^(\d{5})_(.{5})$")
+_LINK_LAST_PAGE_RE = re.compile(r'<[^>]*[?&]page=(\d+)[^>]*>;\s*rel="last"')
+
+
+def get_github_pages(url: str) -> List[dict]:
+    # fetch all pages of a paginated GitHub API listing, `url` must already have a query string
+    response = get(f"{url}&page=1")
+    data = response.json()
+
+    # GitHub discloses the last page in the `Link` header of the first response,
+    # so the remaining pages can be fetched concurrently
+    if match := _LINK_LAST_PAGE_RE.search(response.headers.get("Link", "")):
+        page_urls = [f"{url}&page={page}" for page in range(2, int(match.group(1)) + 1)]
+        with ThreadPoolExecutor(max_workers=min(10, len(page_urls)) or 1) as executor:
+            for page_response in executor.map(get, page_urls):
+                data.extend(page_response.json())
+        return data
 
-
-def get_github_open_pull_requests() -> List[dict]:
-    data = []
     page = 1
-
-    while True:
-        response = get(f"https://api.github.com/repos/{REPOSITORY}/pulls?state=open&sort=created&per_page=100&page={page}")
-        page_data = response.json()
-        data.extend(page_data)
-        if len(page_data) < 100:
-            break
+    page_data = data
+    while len(page_data) >= 100:
         page += 1
+        page_data = get(f"{url}&page={page}").json()
+        data.extend(page_data)
 
     return data
 
 
-def get_github_pull_request_changed_files(pr_number: int) -> List[dict]:
-    data = []
-    page = 1
+def get_github_open_pull_requests() -> List[dict]:
+    return get_github_pages(f"https://api.github.com/repos/{REPOSITORY}/pulls?state=open&sort=created&per_page=100")
 
-    while True:
-        response = get(f"https://api.github.com/repos/{REPOSITORY}/pulls/{pr_number}/files?per_page=100&page={page}")
-        page_data = response.json()
-        data.extend(page_data)
-        if len(page_data) < 100:
-            break
-        page += 1
 
-    return data
+def get_github_pull_request_changed_files(pr_number: int) -> List[dict]:
+    return get_github_pages(f"https://api.github.com/repos/{REPOSITORY}/pulls/{pr_number}/files?per_page=100")
 
 
 def get_github_pull_request_info(pr_number: int) -> dict:
@@ -54,102 +96,265 @@ def get_github_file_contents(sha: str, path: str) -> bytes:
     return response.content
 
 
-def get_next_100_github_master_commits() -> None:
-    page = len(master_commits) // 100
-    response = get(f"https://api.github.com/repos/{REPOSITORY}/commits?page={page}&per_page=100")
-    for commit in response.json():
-        master_commits.append(commit["sha"])
+def get_github_files_at_sha(sha: str, paths: List[str]) -> Dict[str, bytes]:
+    # fetch file contents at a commit with one GraphQL request per 100 files instead of one request per file
+    owner, name = REPOSITORY.split("/")
+    files = {}
+
+    for offset in range(0, len(paths), 100):
+        batch = paths[offset:offset + 100]
+        query = "query($owner: String!, $name: String!, {}) {{ repository(owner: $owner, name: $name) {{ {} }} }}".format(
+            ", ".join(f"$e{i}: String!" for i in range(len(batch))),
+            " ".join(f"f{i}: object(expression: $e{i}) {{ ... on Blob {{ text isTruncated }} }}" for i in range(len(batch))),
+        )
+        variables = {"owner": owner, "name": name}
+        variables.update({f"e{i}": f"{sha}:{path}" for i, path in enumerate(batch)})
+
+        payload = post("https://api.github.com/graphql", {"query": query, "variables": variables}).json()
+        if not payload.get("data"):
+            raise Exception(f"GraphQL query for files at {sha} failed: {payload.get('errors')}")
+
+        for i, path in enumerate(batch):
+            blob = payload["data"]["repository"][f"f{i}"]
+            if blob and blob["text"] is not None and not blob["isTruncated"]:
+                files[path] = blob["text"].encode("utf-8")
+            else:
+                # binary, truncated or missing blobs fall back to the raw contents endpoint
+                files[path] = get_github_file_contents(sha, path)
+
+    return files
 
 
 def get_alembic_ini_paths() -> list:
     # these directories should never be traversed into
-    ignored_directories = [
+    ignored_directories = frozenset({
         "__pycache__",
         "node_modules",
         ".git",
         ".pnpm-store",
-    ]
+    })
 
     alembic_paths = []
 
-    for dirpath, dirnames, _ in os.walk("."):
-        for ignored_name in ignored_directories:
-            if ignored_name in dirnames:
-                dirnames.remove(ignored_name)
-
-        for dirname in dirnames:
-            alembic_file = os.path.join(dirpath, dirname, "alembic.ini")
-            if os.path.isfile(alembic_file):
-                alembic_paths.append(alembic_file)
+    # scandir entries carry the file type from the directory listing,
+    # so only `alembic.ini` candidates need an extra stat
+    directories = ["."]
+    while directories:
+        path = directories.pop()
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in ignored_directories:
+                        directories.append(entry.path)
+                # alembic.ini in the repository root itself is not considered
+                elif entry.name == "alembic.ini" and path != "." and entry.is_file():
+                    alembic_paths.append(entry.path)
 
     return alembic_paths
 
 
-def get_alembic_revision_map() -> Dict[str, Dict[str, Any]]:
+def get_migration_files(version_location: str) -> List[str]:
+    filepaths = []
+
+    directories = [version_location]
+    while directories:
+        path = directories.pop()
+        try:
+            entries = os.scandir(path)
+        except FileNotFoundError:
+            continue
 
-    script_location_regex = re.compile(r"^script_location = (\w+)$", re.DOTALL | re.MULTILINE)
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif entry.name.endswith(".py"):
+                    filepaths.append(entry.path)
 
-    alembic_map = {}
+    return filepaths
+
+
+def get_alembic_revision_map() -> Dict[str, Dict[str, Any]]:
+
+    # collect migration files of all script locations first, so they can be parsed in one go
+    script_location_files = []
     for alembic_ini_path in get_alembic_ini_paths():
-        with open(alembic_ini_path, "r") as fp:
-            alembic_data = fp.read()
+        alembic_ini_directory = os.path.dirname(alembic_ini_path)
 
-        script_locations = script_location_regex.findall(alembic_data)
+        # alembic itself provides `%(here)s` for interpolation in alembic.ini
+        config = configparser.ConfigParser(defaults={"here": os.path.abspath(alembic_ini_directory)})
+        config.read(alembic_ini_path)
 
+        script_locations = [
+            config.get(section, "script_location")
+            for section in config.sections()
+            if config.has_option(section, "script_location")
+        ]
         for script_location in script_locations:
-            script_location = os.path.join(os.path.dirname(alembic_ini_path), script_location)
+            script_location = os.path.join(alembic_ini_directory, script_location)
             script_location = os.path.abspath(script_location)
             version_location = os.path.join(script_location, "versions")
 
-            revision_history = set()
-            down_revisions = set()
+            script_location_files.append((script_location, get_migration_files(version_location)))
+
+    # files whose mtime didn't change since the last run reuse their cached revisions without being read
+    files_revisions = {}
+    files_mtimes = {}
+    changed_filepaths = []
+    for _, filepaths in script_location_files:
+        for filepath in filepaths:
+            mtime = files_mtimes[filepath] = os.stat(filepath).st_mtime_ns
+            if (cached := file_revision_cache.get(filepath)) and cached[0] == mtime:
+                files_revisions[filepath] = cached[1]
+            else:
+                changed_filepaths.append(filepath)
 
-            for dirpath, dirnames, filenames in os.walk(version_location):
-                for filename in filenames:
-                    if not filename.endswith(".py"):
-                        continue
+    # large files are mapped instead of read, hashing and the revision regexes work on the mapping directly;
+    # this only saves the Python-side copy, the content hash still pages in the whole file
+    files_contents = []
+    try:
+        for filepath in changed_filepaths:
+            with open(filepath, "rb") as fp:
+                if os.fstat(fp.fileno()).st_size >= MMAP_MIN_FILE_SIZE:
+                    files_contents.append(mmap.mmap(fp.fileno(), 0, prot=mmap.PROT_READ))
+                else:
+                    files_contents.append(fp.read())
+
+        files_revisions.update(zip(changed_filepaths, parse_revisions_from_files(files_contents)))
+    finally:
+        for file_contents in files_contents:
+            if isinstance(file_contents, mmap.mmap):
+                file_contents.close()
+
+    # rebuilt from the files seen in this run, so removed migrations are evicted
+    file_revision_cache.clear()
+    file_revision_cache.update({
+        filepath: (mtime, files_revisions[filepath])
+        for filepath, mtime in files_mtimes.items()
+    })
 
-                    filepath = os.path.join(dirpath, filename)
-                    with open(filepath, "rb") as fp:
-                        file_contents = fp.read()
+    alembic_map = {}
+    for script_location, filepaths in script_location_files:
+        revision_history = set()
+        down_revisions = set()
 
-                    revision, down_revision = parse_revisions_from_file(file_contents)
-                    if not revision and not down_revision:
-                        continue
+        for filepath in filepaths:
+            revision, down_revision = files_revisions[filepath]
+            if not revision and not down_revision:
+                continue
 
-                    revision_history.add(revision)
+            revision_history.add(revision)
 
-                    if down_revision is None:
-                        pass
-                    elif isinstance(down_revision, str):
-                        down_revisions.add(down_revision)
-                    elif isinstance(down_revision, tuple):
-                        down_revisions.update(down_revision)
-                    else:
-                        raise Exception(f"Implementation Error - unknown down_revision type: {down_revision}")
+            if down_revision is None:
+                pass
+            elif isinstance(down_revision, str):
+                down_revisions.add(down_revision)
+            elif isinstance(down_revision, tuple):
+                down_revisions.update(down_revision)
+            else:
+                raise Exception(f"Implementation Error - unknown down_revision type: {down_revision}")
 
-            if len(revision_history) == 0 and len(down_revisions) == 0:
-                print(f"no revisions found for {script_location}")
-                continue
+        if len(revision_history) == 0 and len(down_revisions) == 0:
+            print(f"no revisions found for {script_location}")
+            continue
 
-            head_revision = revision_history - down_revisions
-            assert len(head_revision) == 1, (script_location, head_revision)
-            head_revision = head_revision.pop()
+        head_revision = revision_history - down_revisions
+        assert len(head_revision) == 1, (script_location, head_revision)
+        head_revision = head_revision.pop()
 
-            alembic_map[script_location] = {
-                "head": head_revision,
-                "history": revision_history,
-            }
+        alembic_map[script_location] = {
+            "head": head_revision,
+            "history": revision_history,
+        }
 
     return alembic_map
 
 
+def load_cache(path: str, version: int) -> dict:
+    try:
+        with open(path, "rb") as fp:
+            cache = pickle.load(fp)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        print(f"failed to load cache {path}: {e!r}")
+        return {}
+
+    if cache.get("version") != version:
+        return {}
+
+    return cache["entries"]
+
+
+def save_cache(path: str, version: int, entries: dict) -> None:
+    # write to a temporary file first so an interrupted run can't leave a truncated cache behind
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as fp:
+        pickle.dump({"version": version, "entries": entries}, fp, protocol=5)
+    os.replace(tmp_path, path)
+
+
+def revision_cache_key(file_contents: bytes) -> bytes:
+    return hashlib.blake2b(file_contents, digest_size=16).digest()
+
+
 def parse_revisions_from_file(file_contents: bytes) -> Tuple[Optional[str], Optional[str]]:
+    # migration files are effectively immutable, so parsed revisions are cached by content hash
+    key = revision_cache_key(file_contents)
+    revision_cache_used_keys.add(key)
+    if (revisions := revision_cache.get(key)) is None:
+        revisions = revision_cache[key] = parse_revisions_uncached(file_contents)
+
+    return revisions
+
+
+def parse_revisions_from_files(files_contents: List[bytes]) -> List[Tuple[Optional[str], Optional[str]]]:
+    keys = [revision_cache_key(file_contents) for file_contents in files_contents]
+    revision_cache_used_keys.update(keys)
+    cache_misses = {
+        key: file_contents
+        for key, file_contents in zip(keys, files_contents)
+        if key not in revision_cache
+    }
+
+    # parsing is CPU-bound and independent per file, spread cold runs over all cores;
+    # for a handful of misses starting worker processes costs more than it saves
+    if len(cache_misses) >= 100:
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            # mmap objects can't be pickled to the workers
+            results = executor.map(
+                parse_revisions_uncached,
+                [bytes(file_contents) for file_contents in cache_misses.values()],
+                chunksize=32,
+            )
+            revision_cache.update(zip(cache_misses.keys(), results))
+    else:
+        for key, file_contents in cache_misses.items():
+            revision_cache[key] = parse_revisions_uncached(file_contents)
+
+    return [revision_cache[key] for key in keys]
+
+
+def parse_revisions_uncached(file_contents: bytes) -> Tuple[Optional[str], Optional[str]]:
+    # fast path: revision and down_revision are emitted by the alembic template as plain literals,
+    # so regexes are enough for nearly every file and ast.parse is only needed for anything unusual
+    if revision_match := _REVISION_RE.search(file_contents):
+        revision = revision_match.group(1).decode("utf-8")
+        if down_revision_match := _DOWN_REVISION_RE.search(file_contents):
+            return revision, down_revision_match.group(1).decode("utf-8")
+        if down_revision_match := _DOWN_REVISION_TUPLE_RE.search(file_contents):
+            return revision, tuple(
+                rev.decode("utf-8") for rev in _QUOTED_REVISION_RE.findall(down_revision_match.group(1))
+            )
+        if _DOWN_REVISION_NONE_RE.search(file_contents):
+            return revision, None
+
     revision = None
     down_revision = None
 
     try:
-        for node in ast.parse(file_contents.decode("utf-8")).body:
+        for node in ast.parse(bytes(file_contents).decode("utf-8")).body:
             if isinstance(node, ast.Assign):
                 for target in node.targets:
                     if target.id == "revision":
@@ -161,8 +366,8 @@ def parse_revisions_from_file(file_contents: bytes) -> Tuple[Optional[str], Opti
                         elif isinstance(down_revision, ast.Tuple):
                             down_revision = tuple(d.value for d in down_revision.elts)
     except Exception:
-        revision_match = re.search(rb"revision = ['\"]([\w_]+)['\"]", file_contents)
-        down_revision_match = re.search(rb"down_revision = ['\"]([\w_]+)['\"]", file_contents)
+        revision_match = _REVISION_FALLBACK_RE.search(file_contents)
+        down_revision_match = _DOWN_REVISION_FALLBACK_RE.search(file_contents)
         if revision_match and down_revision_match:
             revision = revision_match.group(1)
             down_revision = down_revision_match.group(1)
@@ -171,43 +376,25 @@ def parse_revisions_from_file(file_contents: bytes) -> Tuple[Optional[str], Opti
 
 
 def execute(*args) -> int:
-    print(*args)
+    # flush before the child writes to the same file descriptors so output stays in order
+    print(*args, flush=True)
 
-    process = subprocess.Popen(
-        args,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
-    stdout, stderr = process.communicate()
-    if stdout:
-        print(stdout.decode("utf-8"))
-    if stderr:
-        print(stderr.decode("utf-8"))
+    # output is streamed straight through instead of being buffered until the process exits
+    return subprocess.call(args, stdout=sys.stdout, stderr=sys.stderr)
 
-    return process.returncode
+
+def execute_capture(*args, timeout: Optional[float] = None) -> Tuple[int, bytes, bytes]:
+    # raises subprocess.TimeoutExpired if the process doesn't finish in time
+    process = subprocess.run(args, capture_output=True, check=False, timeout=timeout)
+
+    return process.returncode, process.stdout, process.stderr
 
 
 def update_pull_request(pr_number: int, files_to_update: List[dict]) -> None:
     pr_info: dict = get_github_pull_request_info(pr_number)
-    pr_sha: str = pr_info["head"]["sha"]
     pr_branch: str = pr_info["head"]["ref"]
     base_sha: str = pr_info["base"]["sha"]
 
-    fetches = 0
-    while base_sha not in master_commits:
-        fetches += 1
-        if fetches >= 50:
-            print(f"`git fetch master` reached maximum fetch depth of {fetches}")
-            return
-
-        # fetch 99 commits first time, as there is already one commit fetched by GitHub Action
-        deepen = 100 if master_commits else 99
-        if return_code := execute("git", "fetch", f"--deepen={deepen}", "origin", "master"):
-            print(f"`git fetch master` failed with return code {return_code}")
-            return
-
-        get_next_100_github_master_commits()
-
     if return_code := execute("git", "fetch", "origin", pr_branch):
         print(f"`git fetch {pr_branch}` failed with return code {return_code}")
         return
@@ -231,48 +418,79 @@ def update_pull_request(pr_number: int, files_to_update: List[dict]) -> None:
         print("not updating revision id, already updated three times")
         return
 
+    # GitHub Action checks out a shallow clone, the PR's base commit has to be in the local master history
+    # to merge master; checking locally first and unshallowing once replaces deepening 100 commits at a time
+    if execute("git", "merge-base", "--is-ancestor", base_sha, "master"):
+        # on a complete repository (e.g. once an earlier PR of this run unshallowed it) the base is simply
+        # newer than the checked out master, whose head revisions this run was computed from; skip until next run
+        return_code, stdout, _ = execute_capture("git", "rev-parse", "--is-shallow-repository")
+        if return_code or stdout.strip() != b"true":
+            print(f"base commit {base_sha} is not part of local master history, skipping update")
+            return
+
+        if return_code := execute("git", "fetch", "--unshallow", "origin", "master"):
+            print(f"`git fetch master` failed with return code {return_code}")
+            return
+
+        if execute("git", "merge-base", "--is-ancestor", base_sha, "master"):
+            print(f"base commit {base_sha} is not part of master history, skipping update")
+            return
+
     if return_code := execute("git", "merge", "master"):
         print(f"`git merge` failed with return code {return_code}")
         execute("git", "merge", "--abort")
 
     print(f"fixing alembic revisions for branch {pr_branch}")
+    updated_filenames: List[str] = []
     for file_to_update in files_to_update:
         filename: str = file_to_update["filename"]
-        file_contents: bytes = get_github_file_contents(pr_sha, filename)
+        # read from the checked out branch rather than the contents fetched when the PR was checked,
+        # the author may have pushed since and their changes must not be overwritten
+        try:
+            with open(filename, "rb") as fp:
+                file_contents: bytes = fp.read()
+        except FileNotFoundError:
+            print(f"{filename} no longer exists in branch {pr_branch}, skipping it")
+            continue
 
         # update revision id
-        new_file_contents: bytes = re.sub(
+        new_file_contents: bytes = file_contents.replace(
             file_to_update["down_revision"].encode("utf-8"),
             file_to_update["head_revision"].encode("utf-8"),
-            file_contents,
         )
 
         # if revision ids are sequential, bump the filename and current revision id by one
-        if match := re.search(r"^(\d{5})_(.{5})$", file_to_update["head_revision"]):
-            revision_match = re.search(r"^(\d{5})_(.{5})$", file_to_update["revision"])
+        if match := _SEQ_REV_RE.search(file_to_update["head_revision"]):
+            revision_match = _SEQ_REV_RE.search(file_to_update["revision"])
             new_revision_id: str = (
                 str((int(match.group(1)) + 1)).zfill(5)
                 + "_"
                 + (revision_match or match).group(2)
             )
 
-            os.unlink(filename)
-            execute("git", "rm", filename)
-
             new_filename: str = filename.replace(file_to_update["revision"], new_revision_id)
-            new_file_contents = re.sub(
+            new_file_contents = new_file_contents.replace(
                 file_to_update["revision"].encode("utf-8"),
                 new_revision_id.encode("utf-8"),
-                new_file_contents,
             )
-            with open(new_filename, "wb") as fp:
-                fp.write(new_file_contents)
-                fp.truncate()
-            execute("git", "add", new_filename)
+            os.rename(filename, new_filename)
+            updated_filenames.append(new_filename)
         else:
-            with open(filename, "wb") as fp:
-                fp.write(new_file_contents)
-                fp.truncate()
+            new_filename = filename
+
+        with open(new_filename, "wb") as fp:
+            fp.write(new_file_contents)
+        updated_filenames.append(filename)
+
+    # without paths `git add -A` would stage the whole working tree
+    if not updated_filenames:
+        print(f"no alembic files left to update in branch {pr_branch}")
+        return
+
+    # stage all updated and renamed files at once, git picks up renames by itself
+    if return_code := execute("git", "add", "-A", "--", *updated_filenames):
+        print(f"`git add` failed with return code {return_code}")
+        return
 
     if return_code := execute("git", "commit", "-am", "update alembic revision id"):
         print(f"`git commit` failed with return code {return_code}")
@@ -286,133 +504,200 @@ def update_pull_request(pr_number: int, files_to_update: List[dict]) -> None:
 
 
 def get_last_commit_messages(n: int) -> List[str]:
-    process = subprocess.Popen(
-        ["git", "log", "-n", str(n), "--format='%s'"],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
-    stdout, stderr = process.communicate()
-    if process.returncode:
-        print(f"`git log` failed with return code {process.returncode}")
+    # subjects are NUL-delimited, so no quoting or whitespace stripping is needed
+    try:
+        return_code, stdout, stderr = execute_capture("git", "log", "-n", str(n), "--format=%s", "-z", timeout=30)
+    except subprocess.TimeoutExpired:
+        print("`git log` timed out")
+        return []
+
+    if return_code:
+        print(f"`git log` failed with return code {return_code}")
         if stdout:
             print(stdout.decode("utf-8"))
         if stderr:
             print(stderr.decode("utf-8"))
         return []
 
-    messages: List[str] = []
-    for line in stdout.decode("utf-8").split("\n"):
-        line = line.strip(" '")
-        if line:
-            messages.append(line)
-
-    return messages
+    return [message.decode("utf-8") for message in stdout.split(b"\0") if message]
 
 
 def get(url: str) -> requests.Response:
-    for attempt in range(5):
-        try:
-            response = requests.get(url=url, headers={"Authorization": f"token {GITHUB_TOKEN}"})
-            response.raise_for_status()
-            return response
-        except requests.exceptions.HTTPError:
-            if attempt == range(5)[-1]:
-                raise
-            time.sleep(attempt + 1)
+    # GitHub API responses are revalidated with their ETag, 304 responses don't count against the rate limit
+    revalidate = url.startswith("https://api.github.com/")
+    headers = {}
+    if revalidate:
+        etag_cache_used_urls.add(url)
+        if url in etag_cache:
+            headers["If-None-Match"] = etag_cache[url][0]
+
+    # retries with exponential backoff are handled by the session's adapter
+    with github_semaphore:
+        response = github_session.get(url=url, headers=headers, timeout=30)
+    response.raise_for_status()
+
+    if response.status_code == HTTPStatus.NOT_MODIFIED:
+        etag, cached_headers, body = etag_cache[url]
+        cached_response = requests.Response()
+        cached_response.status_code = HTTPStatus.OK
+        cached_response.headers.update(cached_headers)
+        cached_response._content = body
+        cached_response.url = url
+        return cached_response
+
+    if revalidate and (etag := response.headers.get("ETag")):
+        etag_cache[url] = (etag, dict(response.headers), response.content)
+
+    return response
+
+
+def post(url: str, json: dict) -> requests.Response:
+    with github_semaphore:
+        response = github_session.post(url=url, json=json, timeout=30)
+    response.raise_for_status()
+    return response
+
+
+def find_script_location(abs_filename: str, alembic_revisions: Dict[str, Dict[str, Any]]) -> Optional[str]:
+    # walk up the file's parent directories, the first one that is a script location contains it;
+    # this is O(path depth) with dict lookups instead of a prefix check against every script location
+    path = os.path.dirname(abs_filename)
+    while path not in alembic_revisions:
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+    return path
+
+
+def get_pull_request_files_to_update(open_pr: dict, alembic_revisions: Dict[str, Dict[str, Any]], cwd: str) -> Tuple[List[str], List[dict]]:
+    # returns buffered output lines and alembic files of the pull request that need their down_revision fixed
+    pr_sha = open_pr["head"]["sha"]
+    pr_number = open_pr["number"]
+    pr_branch = open_pr["head"]["ref"]
+
+    output = [f"checking pull request #{pr_number}: {pr_branch}"]
+    files_to_update = []
+
+    # get list of changed files for the pull request
+    changed_files = get_github_pull_request_changed_files(pr_number)
+
+    # collect candidate alembic files first, so their contents can be fetched in one batch
+    candidate_files = []
+    for changed_file in changed_files:
+        filename = changed_file["filename"]
+
+        # skip removed files
+        if changed_file["status"] == "removed":
+            continue
 
+        # skip non-python files
+        if not filename.endswith(".py"):
+            continue
 
-def fix_alembic_revisions() -> None:
+        # skip files that are not in the alembic directory
+        # changed file paths are always repository-relative, so joining them onto cwd is enough for an absolute path
+        alembic_script_location = find_script_location(os.path.join(cwd, filename), alembic_revisions)
+        if not alembic_script_location:
+            continue
 
-    alembic_revisions = get_alembic_revision_map()
+        # if revision history is empty, do nothing
+        if not alembic_revisions[alembic_script_location]["history"]:
+            continue
 
-    for open_pr in get_github_open_pull_requests():
-        pr_sha = open_pr["head"]["sha"]
-        pr_number = open_pr["number"]
-        pr_branch = open_pr["head"]["ref"]
-        base_branch = open_pr["base"]["ref"]
+        candidate_files.append((filename, alembic_script_location))
 
-        if base_branch != "master":
-            continue
+    # get full file contents
+    files_contents = get_github_files_at_sha(pr_sha, [filename for filename, _ in candidate_files])
 
-        print(f"checking pull request #{pr_number}: {pr_branch}")
+    for filename, alembic_script_location in candidate_files:
+        head_revision = alembic_revisions[alembic_script_location]["head"]
+        revision_history = alembic_revisions[alembic_script_location]["history"]
+        file_contents: bytes = files_contents[filename]
 
-        files_to_update = []
+        # attempt to parse revision and down_revision from the file
+        revision, down_revision = parse_revisions_from_file(file_contents)
+        if not revision or not down_revision:
+            continue
 
-        # get list of changed files for the pull request
-        changed_files = get_github_pull_request_changed_files(pr_number)
+        # if revision already exists in the revision history then
+        # existing migration is probably being edited in-place
+        # do nothing in this case
+        if revision in revision_history:
+            continue
 
-        for changed_file in changed_files:
-            filename = changed_file["filename"]
-            abs_filename = os.path.abspath(filename)
+        # if down_revision does not exist in the revision history
+        # then the PR probably contains multiple alembic migrations and
+        # this file comes later in the PR's migration chain
+        if down_revision not in revision_history:
+            continue
 
-            # skip removed files
-            if changed_file["status"] == "removed":
-                continue
+        # if down_revision matches head revision, all is good
+        if down_revision == head_revision:
+            continue
 
-            # skip non-python files
-            if not filename.endswith(".py"):
-                continue
+        output.append(
+            "down_revision {}/{} -> {} in {} does not match head revision in master: {}".format(
+                os.path.basename(alembic_script_location),
+                down_revision,
+                revision,
+                pr_branch,
+                head_revision,
+            )
+        )
 
-            # skip files that are not in the alembic directory
-            for script_location in alembic_revisions:
-                if abs_filename.startswith(script_location):
-                    alembic_script_location = script_location
-                    break
-            else:
-                continue
+        files_to_update.append({
+            "filename": filename,
+            "revision": revision,
+            "down_revision": down_revision,
+            "head_revision": head_revision,
+        })
 
-            head_revision = alembic_revisions[alembic_script_location]["head"]
-            revision_history = alembic_revisions[alembic_script_location]["history"]
+    return output, files_to_update
 
-            # if revision history is empty, do nothing
-            if not revision_history:
-                continue
 
-            # get full file contents
-            file_contents: bytes = get_github_file_contents(pr_sha, filename)
+def fix_alembic_revisions() -> None:
 
-            # attempt to parse revision and down_revision from the file
-            revision, down_revision = parse_revisions_from_file(file_contents)
-            if not revision or not down_revision:
-                continue
+    cache = load_cache(REVISION_CACHE_PATH, REVISION_CACHE_VERSION)
+    revision_cache.update(cache.get("revisions", {}))
+    file_revision_cache.update(cache.get("files", {}))
+    etag_cache.update(load_cache(ETAG_CACHE_PATH, ETAG_CACHE_VERSION))
 
-            # if revision already exists in the revision history then
-            # existing migration is probably being edited in-place
-            # do nothing in this case
-            if revision in revision_history:
-                continue
+    cwd = os.getcwd()
+    alembic_revisions = get_alembic_revision_map()
 
-            # if down_revision does not exist in the revision history
-            # then the PR probably contains multiple alembic migrations and
-            # this file comes later in the PR's migration chain
-            if down_revision not in revision_history:
+    open_prs = [open_pr for open_pr in get_github_open_pull_requests() if open_pr["base"]["ref"] == "master"]
+
+    # checking pull requests only talks to the GitHub API, so it is done concurrently;
+    # updating them mutates the working directory and stays serialized on the main thread
+    with ThreadPoolExecutor(max_workers=20) as executor:
+        futures = [
+            executor.submit(get_pull_request_files_to_update, open_pr, alembic_revisions, cwd)
+            for open_pr in open_prs
+        ]
+        for open_pr, future in zip(open_prs, futures):
+            # a failing pull request must not stop the remaining ones from being checked and updated
+            try:
+                output, files_to_update = future.result()
+            except Exception as e:
+                print(f"failed to check pull request #{open_pr['number']}: {e!r}")
                 continue
 
-            # if down_revision matches head revision, all is good
-            if down_revision == head_revision:
-                continue
+            print("\n".join(output))
 
-            print(
-                "down_revision {}/{} -> {} in {} does not match head revision in master: {}".format(
-                    os.path.basename(alembic_script_location),
-                    down_revision,
-                    revision,
-                    pr_branch,
-                    head_revision,
-                )
-            )
+            # if there are files to update, merge master and push commit with
+            # fixed revision ids to the PR
+            if files_to_update:
+                update_pull_request(open_pr["number"], files_to_update)
 
-            files_to_update.append({
-                "filename": filename,
-                "revision": revision,
-                "down_revision": down_revision,
-                "head_revision": head_revision,
-            })
-
-        # if there are files to update, merge master and push commit with
-        # fixed revision ids to the PR
-        if files_to_update:
-            update_pull_request(pr_number, files_to_update)
+    # only keep revisions of file contents seen this run, e.g. superseded versions of PR files are dropped
+    save_cache(REVISION_CACHE_PATH, REVISION_CACHE_VERSION, {
+        "revisions": {key: revision_cache[key] for key in revision_cache_used_keys if key in revision_cache},
+        "files": file_revision_cache,
+    })
+    # drop entries of urls that weren't requested this run, e.g. closed pull requests
+    save_cache(ETAG_CACHE_PATH, ETAG_CACHE_VERSION, {url: etag_cache[url] for url in etag_cache_used_urls if url in etag_cache})
 
 
 if __name__ == "__main__":